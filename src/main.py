@@ -1,57 +1,108 @@
 from repo_manager import GitRepoManager
+import argparse
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from pathlib import Path
 
+logger = logging.getLogger("main")
+
+def default_jobs() -> int:
+    """Default worker count: 3/4 of the available CPUs, capped at 8"""
+    return max(1, min(8, (os.cpu_count() or 4) * 3 // 4))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sync local git repositories to private GitHub repositories")
+    parser.add_argument(
+        '-j', '--jobs', '--threads',
+        dest='jobs',
+        type=int,
+        default=os.getenv('SYNC_JOBS', default_jobs()),
+        help="Number of repositories to process in parallel (default: $SYNC_JOBS or 3/4 of the CPUs, at most 8)"
+    )
+    return parser.parse_args()
+
+def process_repository(manager: GitRepoManager, repo_path: Path):
+    """Create or get the GitHub repository for a local repository and sync it"""
+    logger.info(f"Processing repository: {repo_path.name}")
+    
+    try:
+        # Create or get GitHub repository and add remote
+        github_repo = manager.create_or_get_github_repo(repo_path)
+        
+        if github_repo:
+            # Only sync if we have a valid GitHub repository
+            manager.sync_repository(repo_path, "origin", "github")
+        else:
+            logger.warning(f"Skipping sync for {repo_path.name} due to GitHub repository issues")
+    finally:
+        # Close the repository's git processes so they don't pile up across repositories
+        manager.release_repo(repo_path)
+    
+    logger.info(f"Finished processing {repo_path.name}")
+
 def main():
     # Load environment variables
     load_dotenv()
     
+    args = parse_args()
+    
+    # Log through logging rather than print so lines from worker threads don't interleave
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'
+    )
+    
     # Get configuration from environment variables
     folder_path = os.getenv('REPOS_FOLDER')
     github_token = os.getenv('GITHUB_TOKEN')
     
     # Validate environment variables
     if not folder_path:
-        print("Error: REPOS_FOLDER environment variable is not set")
+        logger.error("REPOS_FOLDER environment variable is not set")
         return
     
     if not github_token:
-        print("Error: GITHUB_TOKEN environment variable is not set")
+        logger.error("GITHUB_TOKEN environment variable is not set")
         return
     
     # Validate folder exists
     if not os.path.isdir(folder_path):
-        print(f"Error: Folder {folder_path} does not exist")
+        logger.error(f"Folder {folder_path} does not exist")
+        return
+    
+    if args.jobs < 1:
+        logger.error("--jobs must be at least 1")
         return
     
-    manager = GitRepoManager(folder_path, github_token)
+    manager = GitRepoManager(folder_path, github_token, jobs=args.jobs)
     
     # Find all repositories
     repos = manager.find_git_repositories()
     
     if not repos:
-        print("No git repositories found!")
+        logger.info("No git repositories found!")
         return
     
-    print(f"Found {len(repos)} repositories to process")
+    logger.info(f"Found {len(repos)} repositories to process")
     
-    # Process each repository
-    for repo_path in repos:
-        print(f"\nProcessing repository: {repo_path.name}")
-        
-        # Create or get GitHub repository and add remote
-        github_repo = manager.create_or_get_github_repo(repo_path)
-        
-        if github_repo:
-            # Only sync if we have a valid GitHub repository
-            manager.sync_repository(repo_path, "origin", "github")
-        else:
-            print(f"Skipping sync for {repo_path.name} due to GitHub repository issues")
-        
-        print(f"Finished processing {repo_path.name}")
+    # Create missing GitHub repositories up front, several per request
+    manager.create_missing_github_repos(repos)
+    
+    # Process repositories in parallel; the work is dominated by network I/O
+    with ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="sync") as executor:
+        futures = {
+            executor.submit(process_repository, manager, repo_path): repo_path
+            for repo_path in repos
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Error processing {futures[future].name}: {str(e)}")
     
-    print("\nAll repositories processed!")
+    logger.info("All repositories processed!")
 
 if __name__ == "__main__":
     main() 
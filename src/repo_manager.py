@@ -1,30 +1,87 @@
-from git import Repo
-from github import Github
+from __future__ import annotations
+
+import json
 import os
 from pathlib import Path
 import logging
-from typing import List
+import threading
+from collections import defaultdict
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+# git and github are heavy to import, so they are imported where first needed
+if TYPE_CHECKING:
+    from git import Repo
+
+REPO_CACHE_FILE = Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "sync-git-repository" / "repos.json"
+
+# Repository fields kept in the on-disk cache
+REPO_CACHE_FIELDS = ("name", "full_name", "clone_url", "url", "private")
+
+# Number of createRepository mutations sent in a single GraphQL request
+CREATE_BATCH_SIZE = 50
 
 class GitRepoManager:
-    def __init__(self, folder_path: str, github_token: str):
+    def __init__(self, folder_path: str, github_token: str, jobs: Optional[int] = None):
+        from github import Github, GithubRetry
+        
         self.folder_path = Path(folder_path)
-        self.github_client = Github(github_token)
+        self.jobs = jobs or os.cpu_count() or 1
+        # Use the largest page size so listing owned repositories takes as few requests as possible,
+        # and keep at least one pooled keep-alive connection per worker (never fewer than requests'
+        # default of 10) so calls don't redo the TLS handshake
+        self.github_client = Github(
+            github_token,
+            per_page=100,
+            pool_size=max(self.jobs, 10),
+            retry=GithubRetry(backoff_factor=0.5)
+        )
+        self._user = self.github_client.get_user()
+        self._repo_index = None
+        self._repo_index_failed = False
+        self._batch_created = set()
+        self._repo_index_lock = threading.Lock()
+        self._repos: Dict[Path, Repo] = {}
+        self._repo_locks = defaultdict(threading.Lock)
+        self._locks_guard = threading.Lock()
         self.setup_logging()
     
     def setup_logging(self):
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s'
-        )
+        # Logging is configured once by the application (see main.py)
         self.logger = logging.getLogger(__name__)
     
+    def _lock_for(self, repo_path: Path) -> threading.Lock:
+        """Get the lock serializing git operations on a repository"""
+        with self._locks_guard:
+            return self._repo_locks[repo_path.resolve()]
+    
+    def _repo(self, repo_path: Path) -> Repo:
+        """Get the cached Repo for a path; callers must hold the repository lock"""
+        from git import GitCmdObjectDB, Repo
+        
+        key = repo_path.resolve()
+        repo = self._repos.get(key)
+        if repo is None:
+            # These are GitPython's defaults, pinned on purpose: objects are read through the git CLI
+            # (not the pure-python object database) and only the given path is considered
+            repo = self._repos[key] = Repo(repo_path, odbt=GitCmdObjectDB, search_parent_directories=False)
+        return repo
+    
+    def release_repo(self, repo_path: Path):
+        """Drop the cached Repo for a path and close its persistent git processes"""
+        with self._lock_for(repo_path):
+            repo = self._repos.pop(repo_path.resolve(), None)
+            if repo is not None:
+                repo.close()
+    
     def find_git_repositories(self) -> List[Path]:
         """Find all git repositories in the specified folder"""
-        git_repos = []
-        for item in self.folder_path.glob("*"):
-            if item.is_dir() and (item / ".git").exists():
-                git_repos.append(item)
-        return git_repos
+        # os.scandir exposes the entry type without an extra stat per entry
+        with os.scandir(self.folder_path) as entries:
+            return [
+                Path(entry.path)
+                for entry in entries
+                if entry.is_dir() and os.path.exists(os.path.join(entry.path, ".git"))
+            ]
     
     def get_default_branch(self, repo: Repo) -> str:
         """Detect the default branch (main or master)"""
@@ -32,8 +89,8 @@ class GitRepoManager:
             # First try to get it from the remote
             default_branch = repo.active_branch.name
             
-            # Check if main or master exists
-            branches = [ref.name for ref in repo.references]
+            # Check if main or master exists among local branches only
+            branches = {head.name for head in repo.heads}
             if 'main' in branches:
                 return 'main'
             elif 'master' in branches:
@@ -45,108 +102,328 @@ class GitRepoManager:
             return 'main'
     
     def cleanup_sync_branches(self, repo: Repo):
-        """Clean up any sync-related branches"""
+        """Clean up sync branches created by previous versions of this tool"""
         branches_to_remove = [
             "sync_temp",
             "sync_origin_github"  # Old branch name
         ]
         
+        # List heads once; on steady-state runs there is nothing to delete
+        heads = {head.name for head in repo.heads}
         for branch_name in branches_to_remove:
+            if branch_name not in heads:
+                continue
             try:
-                if branch_name in repo.heads:
-                    self.logger.info(f"Removing old branch '{branch_name}'")
-                    # Ensure we're not on the branch we're trying to delete
-                    if repo.active_branch.name == branch_name:
-                        default_branch = self.get_default_branch(repo)
-                        repo.heads[default_branch].checkout()
-                    repo.delete_head(branch_name, force=True)
+                self.logger.info(f"Removing old branch '{branch_name}'")
+                # Ensure we're not on the branch we're trying to delete
+                if repo.active_branch.name == branch_name:
+                    default_branch = self.get_default_branch(repo)
+                    repo.heads[default_branch].checkout()
+                repo.delete_head(branch_name, force=True)
             except Exception as e:
                 self.logger.warning(f"Could not delete branch '{branch_name}': {str(e)}")
 
-    def sync_repository(self, repo_path: Path, source_remote: str, target_remote: str):
-        """Sync repository from source remote to target remote using a temporary branch"""
+    def is_fast_forward(self, repo: Repo, target_remote: str, target_ref: str, target_sha: str, source_sha: str) -> bool:
+        """Check that the target commit is an ancestor of the source commit, fetching it if needed"""
+        from git import GitCommandError
+        
         try:
-            repo = Repo(repo_path)
-            
-            # Detect default branch
-            default_branch = self.get_default_branch(repo)
-            self.logger.info(f"Detected default branch '{default_branch}' for {repo_path.name}")
-            
-            # Clean up any old sync branches
-            self.cleanup_sync_branches(repo)
-            
-            # Create a temporary branch name
-            temp_branch = "sync_temp"
-            
-            # Fetch from source remote
-            source = repo.remote(source_remote)
-            self.logger.info(f"Fetching from {source_remote} for {repo_path.name}")
-            source.fetch()
-            
-            # Create and checkout new temporary branch from default branch
-            current = repo.create_head(temp_branch, commit=f'{source_remote}/{default_branch}')
-            current.checkout()
-            
-            # Pull from source
-            source.pull(refspec=f'{default_branch}:{temp_branch}')
-            
-            # Push to target
-            target = repo.remote(target_remote)
-            self.logger.info(f"Pushing to {target_remote} for {repo_path.name}")
-            target.push(temp_branch)
-            
-            # Clean up: checkout default branch and delete temporary branch
+            repo.git.cat_file("-e", f"{target_sha}^{{commit}}")
+        except GitCommandError:
+            repo.git.fetch(target_remote, target_ref)
+        return repo.is_ancestor(target_sha, source_sha)
+    
+    def sync_repository(self, repo_path: Path, source_remote: str, target_remote: str):
+        """Sync the default branch from source remote to target remote without touching the working tree"""
+        with self._lock_for(repo_path):
             try:
-                default = repo.heads[default_branch]
-                default.checkout()
-                repo.delete_head(temp_branch, force=True)
-                self.logger.info(f"Cleaned up temporary branch in {repo_path.name}")
-            except Exception as e:
-                self.logger.warning(f"Could not clean up temp branch: {str(e)}")
+                repo = self._repo(repo_path)
                 
-        except Exception as e:
-            self.logger.error(f"Error syncing repository {repo_path.name}: {str(e)}")
+                # Detect default branch
+                default_branch = self.get_default_branch(repo)
+                self.logger.info(f"Detected default branch '{default_branch}' for {repo_path.name}")
+                
+                # Clean up sync branches left behind by previous versions
+                self.cleanup_sync_branches(repo)
+                
+                # Fetch the default branch from source remote
+                self.logger.info(f"Fetching from {source_remote} for {repo_path.name}")
+                repo.git.fetch(f"--jobs={self.jobs}", source_remote, default_branch)
+                
+                # Skip the push when the target branch already points at the source commit
+                source_ref = f"refs/remotes/{source_remote}/{default_branch}"
+                target_ref = f"refs/heads/{default_branch}"
+                source_sha = repo.commit(source_ref).hexsha
+                remote_refs = repo.git.ls_remote(target_remote, target_ref).split()
+                target_sha = remote_refs[0] if remote_refs else ""
+                if target_sha == source_sha:
+                    self.logger.info(f"{target_remote} is up-to-date for {repo_path.name}, skipping push")
+                    return
+                
+                # Never overwrite history: only fast-forward the target branch
+                if target_sha and not self.is_fast_forward(repo, target_remote, target_ref, target_sha, source_sha):
+                    self.logger.warning(
+                        f"{target_remote}/{default_branch} has diverged from {source_remote}/{default_branch} "
+                        f"for {repo_path.name}, skipping push"
+                    )
+                    return
+                
+                # Push the fetched remote-tracking ref straight to the target branch,
+                # only if the target still points where ls-remote saw it
+                self.logger.info(f"Pushing to {target_remote} for {repo_path.name}")
+                repo.git.push(
+                    "--atomic",
+                    f"--force-with-lease={target_ref}:{target_sha}",
+                    target_remote,
+                    f"{source_ref}:{target_ref}"
+                )
+                    
+            except Exception as e:
+                self.logger.error(f"Error syncing repository {repo_path.name}: {str(e)}")
     
-    def get_existing_github_repo(self, repo_name: str):
-        """Check if GitHub repository already exists"""
+    def read_repo_cache(self) -> list:
+        """Read the cached owned-repositories pages saved by a previous run"""
         try:
-            return self.github_client.get_user().get_repo(repo_name)
-        except Exception:
-            return None
+            with open(REPO_CACHE_FILE) as f:
+                pages = json.load(f).get("pages")
+            if isinstance(pages, list) and all(page.get("etag") for page in pages):
+                return pages
+        except (OSError, ValueError, AttributeError):
+            pass
+        return []
     
-    def create_or_get_github_repo(self, repo_path: Path):
-        """Create private GitHub repository if it doesn't exist and add it as remote"""
+    def write_repo_cache(self, pages: list):
+        """Save the owned-repositories pages and their ETags for the next run, readable by the owner only"""
         try:
-            repo = Repo(repo_path)
-            repo_name = repo_path.name
-            
-            # First check if repository already exists on GitHub
-            github_repo = self.get_existing_github_repo(repo_name)
+            REPO_CACHE_FILE.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            fd = os.open(REPO_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"pages": pages}, f)
+        except OSError as e:
+            self.logger.warning(f"Could not write repository cache {REPO_CACHE_FILE}: {str(e)}")
+    
+    def list_owned_repos(self) -> dict:
+        """List the GitHub repositories owned by the user, revalidating each cached page by ETag"""
+        from github.Repository import Repository
+        
+        cached_pages = self.read_repo_cache()
+        pages = []
+        has_next = True
+        while has_next:
+            page_number = len(pages) + 1
+            cached = cached_pages[page_number - 1] if page_number <= len(cached_pages) else None
+            headers = {"If-None-Match": cached["etag"]} if cached else {}
+            # PyGithub has no public conditional-request API, so go through the user's requester
+            status, response_headers, output = self._user._requester.requestJson(
+                "GET",
+                "/user/repos",
+                parameters={"type": "owner", "per_page": 100, "page": page_number},
+                headers=headers
+            )
             
-            if github_repo:
-                self.logger.info(f"Found existing GitHub repository for {repo_name}")
+            if status == 304 and cached:
+                # Not modified: doesn't count against the rate limit. The ETag only covers the body,
+                # so a full page may have gained a next page since it was cached
+                page = dict(cached, has_next=(
+                    'rel="next"' in response_headers.get("link", "")
+                    or len(cached["repos"]) >= 100
+                ))
+            elif status == 200 and response_headers.get("etag"):
+                page = {
+                    "etag": response_headers["etag"],
+                    # Keep only what is used, not the full description of private repositories
+                    "repos": [
+                        {field: raw.get(field) for field in REPO_CACHE_FIELDS}
+                        for raw in json.loads(output)
+                    ],
+                    "has_next": 'rel="next"' in response_headers.get("link", ""),
+                }
             else:
-                # Create new private GitHub repository
-                self.logger.info(f"Creating new GitHub repository for {repo_name}")
-                github_repo = self.github_client.get_user().create_repo(
-                    repo_name,
-                    private=True
-                )
-            
-            # Add as remote if it doesn't exist
-            remote_name = "github"
-            remote_url = github_repo.clone_url
+                # Unexpected response: let the regular listing raise or handle it
+                return {r.name.lower(): r for r in self._user.get_repos(type="owner")}
             
-            # Check if remote already exists
-            existing_remotes = [remote.name for remote in repo.remotes]
-            if remote_name not in existing_remotes:
-                repo.create_remote(remote_name, remote_url)
-                self.logger.info(f"Added GitHub remote to {repo_name}")
-            else:
-                self.logger.info(f"GitHub remote already exists for {repo_name}")
+            pages.append(page)
+            has_next = page.get("has_next", False)
+        
+        if pages != cached_pages:
+            self.write_repo_cache(pages)
+        else:
+            self.logger.info("Owned GitHub repositories unchanged, using cached listing")
+        
+        return {
+            raw["name"].lower(): self.github_client.create_from_raw_data(Repository, raw)
+            for page in pages
+            for raw in page["repos"]
+        }
+    
+    def get_repo_index(self) -> dict:
+        """Get the GitHub repositories owned by the user, indexed by lowercased name (fetched once, None if that failed)"""
+        with self._repo_index_lock:
+            if self._repo_index is None and not self._repo_index_failed:
+                try:
+                    self._repo_index = self.list_owned_repos()
+                except Exception as e:
+                    # Don't retry the listing for every repository; callers look repositories up one by one
+                    self._repo_index_failed = True
+                    self.logger.warning(f"Could not list owned GitHub repositories: {str(e)}")
+            return self._repo_index
+    
+    def find_github_repo(self, repo_name: str):
+        """Look up a single GitHub repository owned by the user, bypassing the index"""
+        from github import UnknownObjectException
+        
+        try:
+            return self._user.get_repo(repo_name)
+        except UnknownObjectException:
+            return None
+    
+    def get_existing_github_repo(self, repo_name: str):
+        """Check if GitHub repository already exists"""
+        repo_index = self.get_repo_index()
+        if repo_index is not None:
+            # GitHub resolves repository names case-insensitively
+            return repo_index.get(repo_name.lower())
+        
+        # Listing failed, fall back to looking up this repository alone
+        return self.find_github_repo(repo_name)
+    
+    def create_github_repos_batch(self, repo_names: List[str]) -> dict:
+        """Create private GitHub repositories in a single GraphQL request"""
+        from github.Repository import Repository
+        
+        # One aliased createRepository mutation per repository, each with its own input variable
+        variables = {f"r{i}": {"name": name, "visibility": "PRIVATE"} for i, name in enumerate(repo_names)}
+        params = ", ".join(f"${alias}: CreateRepositoryInput!" for alias in variables)
+        fields = " ".join(
+            f"{alias}: createRepository(input: ${alias}) {{ repository {{ name nameWithOwner url }} }}"
+            for alias in variables
+        )
+        requester = self._user._requester
+        _, data = requester.requestJsonAndCheck(
+            "POST",
+            requester.graphql_url,
+            input={"query": f"mutation({params}) {{ {fields} }}", "variables": variables}
+        )
+        
+        for error in data.get("errors") or []:
+            self.logger.warning(f"GraphQL repository creation error: {error.get('message')}")
+        
+        created = {}
+        results = data.get("data") or {}
+        for alias, variable in variables.items():
+            result = results.get(alias)
+            if not result or not result.get("repository"):
+                continue
+            repository = result["repository"]
+            created[variable["name"].lower()] = self.github_client.create_from_raw_data(Repository, {
+                "name": repository["name"],
+                "full_name": repository["nameWithOwner"],
+                "html_url": repository["url"],
+                "clone_url": f"{repository['url']}.git",
+                "url": f"{requester.base_url}/repos/{repository['nameWithOwner']}",
+                "private": True,
+            })
+        return created
+    
+    def can_open_repo(self, repo_path: Path) -> bool:
+        """Check that a local repository can be opened (the error is logged when it is processed)"""
+        with self._lock_for(repo_path):
+            try:
+                self._repo(repo_path)
+                return True
+            except Exception:
+                return False
+    
+    def create_missing_github_repos(self, repo_paths: List[Path]):
+        """Create GitHub repositories for all local repositories missing on GitHub, in batches"""
+        repo_index = self.get_repo_index()
+        if repo_index is None:
+            return
+        
+        # Only create remote repositories for local repositories that can actually be synced
+        missing = sorted(
+            repo_path.name
+            for repo_path in repo_paths
+            if repo_path.name.lower() not in repo_index and self.can_open_repo(repo_path)
+        )
+        for start in range(0, len(missing), CREATE_BATCH_SIZE):
+            batch = missing[start:start + CREATE_BATCH_SIZE]
+            self.logger.info(f"Creating {len(batch)} new GitHub repositories")
+            try:
+                created = self.create_github_repos_batch(batch)
+            except Exception as e:
+                self.logger.warning(f"Batch repository creation failed: {str(e)}")
+                created = {}
+            if created:
+                self.logger.info(f"Created {len(created)} GitHub repositories: {', '.join(sorted(created))}")
             
-            return github_repo
+            # A failed alias may still exist, e.g. created by a retried request, so look it up
+            # before leaving it to be created one by one in create_or_get_github_repo
+            found = {}
+            for name in batch:
+                if name.lower() in created:
+                    continue
+                try:
+                    github_repo = self.find_github_repo(name)
+                except Exception as e:
+                    self.logger.warning(f"Could not look up GitHub repository {name}: {str(e)}")
+                    continue
+                if github_repo:
+                    found[name.lower()] = github_repo
             
-        except Exception as e:
-            self.logger.error(f"Error processing GitHub repository for {repo_path.name}: {str(e)}")
-            return None
+            with self._repo_index_lock:
+                repo_index.update(created)
+                repo_index.update(found)
+                self._batch_created.update(created)
+    
+    def create_or_get_github_repo(self, repo_path: Path):
+        """Create private GitHub repository if it doesn't exist and add it as remote"""
+        from github import GithubException
+        
+        with self._lock_for(repo_path):
+            try:
+                repo = self._repo(repo_path)
+                repo_name = repo_path.name
+                
+                # First check if repository already exists on GitHub
+                github_repo = self.get_existing_github_repo(repo_name)
+                
+                if github_repo and repo_name.lower() in self._batch_created:
+                    self.logger.info(f"Using GitHub repository created in this run for {repo_name}")
+                elif github_repo:
+                    self.logger.info(f"Found existing GitHub repository for {repo_name}")
+                else:
+                    # Create new private GitHub repository
+                    self.logger.info(f"Creating new GitHub repository for {repo_name}")
+                    try:
+                        github_repo = self._user.create_repo(
+                            repo_name,
+                            private=True
+                        )
+                    except GithubException as e:
+                        # 422 when the repository exists after all, e.g. created by a retried request
+                        github_repo = self.find_github_repo(repo_name) if e.status == 422 else None
+                        if not github_repo:
+                            raise
+                    with self._repo_index_lock:
+                        if self._repo_index is not None:
+                            self._repo_index[repo_name.lower()] = github_repo
+                
+                # Add as remote if it doesn't exist
+                remote_name = "github"
+                remote_url = github_repo.clone_url
+                
+                # Check if remote already exists
+                existing_remotes = [remote.name for remote in repo.remotes]
+                if remote_name not in existing_remotes:
+                    repo.create_remote(remote_name, remote_url)
+                    self.logger.info(f"Added GitHub remote to {repo_name}")
+                else:
+                    self.logger.info(f"GitHub remote already exists for {repo_name}")
+                
+                return github_repo
+                
+            except Exception as e:
+                self.logger.error(f"Error processing GitHub repository for {repo_path.name}: {str(e)}")
+                return None